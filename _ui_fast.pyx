@@ -0,0 +1,45 @@
+# cython: language_level=3
+# C version of UITool.update_chunk, build with `cythonize -i _ui_fast.pyx`.
+# ui.py falls back to the pure-Python path when this is not built.
+
+
+cdef bytes _move_seq(int n, int col):
+    # same sequence as CursorTool.move_to_seq
+    if n > 0:
+        return b"\x1b[%dB\x1b[%dG" % (n, col + 1)
+    if n < 0:
+        return b"\x1b[%dA\x1b[%dG" % (-n, col + 1)
+    return b"\x1b[%dG" % (col + 1)
+
+
+cpdef bytes update_chunk(
+    list line_pos, int line, int cur_line, int cur_col, int max_lines, bytes data
+):
+    """Returns the bytes to write, leaving the cursor at (max_lines, 0)."""
+    cdef const unsigned char* buf = data
+    cdef Py_ssize_t n = len(data)
+    cdef Py_ssize_t i = 0
+    cdef Py_ssize_t start
+    cdef int pos = line_pos[line]
+    out = bytearray()
+
+    while i < n:
+        # each "\r" or "\n" rewinds the line, runs in between are written at once
+        if buf[i] == 13 or buf[i] == 10:
+            pos = 0
+            i += 1
+            continue
+        start = i
+        while i < n and buf[i] != 13 and buf[i] != 10:
+            i += 1
+        if line != cur_line or pos != cur_col:
+            out += _move_seq(line - cur_line, pos)
+            cur_line = line
+        out += buf[start:i]
+        pos += <int>(i - start)
+        cur_col = pos
+
+    line_pos[line] = pos
+    if cur_line != max_lines or cur_col != 0:
+        out += _move_seq(max_lines - cur_line, 0)
+    return bytes(out)
@@ -1,13 +1,16 @@
+import os
+import pty
+import selectors
 import subprocess
+import threading
 from pathlib import Path
 from typing import Optional
 
 import typer
-import yaml
 
 from sync_log import Logger
 from ui import CursorTool, UITool, blue_block, red_block, yellow_block
-from utils import get_lsync_dir, popen_with_error_check
+from utils import get_lsync_dir, load_config, popen_with_error_check
 
 logger = Logger()
 
@@ -19,33 +22,35 @@ LSYNC_DIR = get_lsync_dir()
 TOP_DIRS = ["common_sync"]
 DEFAULT_CONFIG = f"{LSYNC_DIR}/lsync_config.yaml"
 RSYNCIGNORE = f"{LSYNC_DIR}/.lsyncignore"
-
-
-def _sync_command(
-    remote_dir: str,
-    local_dir: str,
-    delete: bool = False,
-    git_repo: bool = False,
-    git_ignore: Optional[str] = None,
-):
-    src_dir, dst_dir = local_dir, remote_dir
-
-    rsync_cmd = [
-        "rsync",
-        "-ah",
-        "--delete" if delete else "",
-        "--info=progress2",
-        f"--exclude-from={git_ignore}" if git_ignore else "",
-        f"--exclude-from={RSYNCIGNORE}",
-        "--exclude=.git" if not git_repo else "",
-        src_dir,
-        dst_dir,
-    ]
-    # remove empty strings
-    rsync_cmd = [cmd for cmd in rsync_cmd if cmd]
-    typer.echo(f"Executing: \x1b[42m{' '.join(rsync_cmd)}\x1b[0m")
-
-    return rsync_cmd
+# ssh multiplexing sockets, %C keeps the path short enough for a unix socket
+SSH_CONTROL_DIR = f"{LSYNC_DIR}/.ssh"
+SSH_COMMAND = (
+    f"ssh -o ControlMaster=auto -o ControlPath={SSH_CONTROL_DIR}/%C"
+    " -o ControlPersist=60s"
+)
+# per-link rsync tuning, zstd needs rsync >= 3.2 on both ends
+LINK_ARGS = {
+    "lan": ("--whole-file",),
+    "wan": ("--compress", "--compress-choice=zstd", "--compress-level=3"),
+}
+# per-workload rsync strategy, --inplace gives up resuming partial transfers
+STRATEGY_ARGS = {
+    "many_small": ("--no-inc-recursive",),
+    "few_large": ("--inplace", "-W"),
+}
+
+
+# one host's rsync: its UI line, process and the fds the selector watches
+class HostSlot:
+    __slots__ = ("line", "name", "cmd", "proc", "fd", "pidfd")
+
+    def __init__(self, line: int, name: str, cmd: list[str]):
+        self.line = line
+        self.name = name
+        self.cmd = cmd
+        self.proc: Optional[subprocess.Popen] = None
+        self.fd: Optional[int] = None
+        self.pidfd: Optional[int] = None
 
 
 class SyncTool:
@@ -55,6 +60,7 @@ class SyncTool:
         file_or_path: Optional[str],
         delete: bool,
         git_repo: bool,
+        jobs: Optional[int] = None,
     ):
         self.server_config = server_config
         self.hosts = self.server_config["hosts"]
@@ -62,16 +68,20 @@ class SyncTool:
 
         if file_or_path is None:
             self.local_dir = self.ancestor_to_sync
-            self.remote_dir = Path(self.server_config["base_dir"]) / self.local_dir.name
         else:
             self.local_dir = Path.cwd() / file_or_path
-            relative_path = self.local_dir.relative_to(self.ancestor_to_sync.parent)
-            self.remote_dir = Path(self.server_config["base_dir"]) / relative_path
+        self._relpath = self.local_dir.relative_to(self.ancestor_to_sync.parent)
+        self.remote_dir = Path(self.server_config["base_dir"]) / self._relpath
 
         # arguments
         self.delete = delete
         self.git_repo = git_repo
+        self.jobs = jobs
+        self._stop = threading.Event()
+        self._error: Optional[Exception] = None
         self.git_ignore = self._probe_gitignore()
+        self.rsync_ignore = self._probe_rsyncignore()
+        os.makedirs(SSH_CONTROL_DIR, mode=0o700, exist_ok=True)
 
         self.__post_init__()
 
@@ -87,8 +97,8 @@ class SyncTool:
 
         logger.print_last_log()
 
+    def _print_target(self, relative_path: str):
         src, dst = ("macbook", self.hosts)
-        relative_path = self.local_dir.relative_to(self.ancestor_to_sync.parent)
         typer.echo(
             f"Syncing folder {blue_block(relative_path)} from "
             f"{blue_block(src)} -> {blue_block(dst)} "
@@ -98,61 +108,253 @@ class SyncTool:
         if not isinstance(self.hosts, list):
             self.hosts = [self.hosts]
 
+        # a host is either a plain name or {"name": ..., "link": "lan" | "wan"}
+        default_link = self.server_config.get("link")
+        self.host_links = {}
+        for host in self.hosts:
+            if isinstance(host, dict):
+                self.host_links[host["name"]] = host.get("link", default_link)
+            else:
+                self.host_links[host] = default_link
+        self.hosts = list(self.host_links)
+        for host, link in self.host_links.items():
+            if link is not None and link not in LINK_ARGS:
+                raise typer.Exit(f"Invalid link type for {host}: {link}")
+        self.jobs = max(1, self.jobs or len(self.hosts))
+
+        strategy = self.server_config.get("strategy")
+        if strategy is not None and strategy not in STRATEGY_ARGS:
+            raise typer.Exit(f"Invalid strategy: {strategy}")
+
+        # adding trailing slash to sync the content of the directory
+        self._trailing = "/" if self.local_dir.is_dir() else ""
+
+        # the rsync argv shared by every host, only src/dst differ
+        self._base_args = tuple(
+            arg
+            for arg in (
+                "rsync",
+                "-ah",
+                "--delete" if self.delete else None,
+                "--info=progress2",
+                f"--exclude-from={self.git_ignore}" if self.git_ignore else None,
+                f"--exclude-from={self.rsync_ignore}",
+                "--exclude=.git" if not self.git_repo else None,
+                *STRATEGY_ARGS.get(strategy, ()),
+            )
+            if arg
+        )
+
     def find_ancestor_to_sync(self) -> Path:
-        d = Path.cwd()
-        while d.as_posix() != "/":
-            if d.name in TOP_DIRS:
-                return d
-            d = d.parent
-        raise typer.Exit(f"No ancestor directory in {TOP_DIRS} found in {Path.cwd()}")
+        cwd = os.getcwd()
+        parts = cwd.split("/")
+        targets = frozenset(TOP_DIRS)
+        for i in range(len(parts), 0, -1):
+            if parts[i - 1] in targets:
+                return Path("/".join(parts[:i]))
+        raise typer.Exit(f"No ancestor directory in {TOP_DIRS} found in {cwd}")
 
     def _probe_gitignore(self) -> Optional[str]:
         gitignore_file = self.local_dir / ".gitignore"
         return gitignore_file.as_posix() if gitignore_file.exists() else None
 
-    def _ui_thread(self, rsync_procs: list[subprocess.Popen]):
-        with UITool.ui_tool(len(rsync_procs)) as ui_tool:
-            while not all(p.poll() is not None for p in rsync_procs):
-                for i, p in enumerate(rsync_procs):
-                    if p.stdout and (char := p.stdout.read(1)):
-                        ui_tool.update_char(i, char)
+    def _probe_rsyncignore(self) -> str:
+        # the excludes also protect ignored paths from --delete, never drop them
+        if not os.path.exists(RSYNCIGNORE):
+            raise typer.Exit(f"Missing {RSYNCIGNORE}, is LSYNC_DIR set correctly?")
+        return RSYNCIGNORE
+
+    def _is_local(self, host: str) -> bool:
+        return host == "localhost" or host in self.server_config.get("local_hosts", [])
+
+    def _host_args(self, host: str) -> tuple[str, ...]:
+        # local copies need neither the ssh transport nor link tuning
+        if self._is_local(host):
+            return ()
+        return ("-e", SSH_COMMAND, *LINK_ARGS.get(self.host_links[host], ()))
+
+    def _host_path(self, host: str, path: str) -> str:
+        # a plain destination path makes rsync copy locally: no ssh and no
+        # delta-transfer (--whole-file is the default for local copies)
+        return path if self._is_local(host) else f"{host}:{path}"
+
+    def _sync_command(
+        self, src_dir: str, dst_dir: str, extra_args: tuple[str, ...] = ()
+    ) -> list[str]:
+        rsync_cmd = [*self._base_args, *extra_args, src_dir, dst_dir]
+        typer.echo(f"Executing: \x1b[42m{' '.join(rsync_cmd)}\x1b[0m")
+
+        return rsync_cmd
+
+    def _ui_thread(self, done: threading.Event, stdin_data: Optional[str] = None):
+        try:
+            self._ui_loop(stdin_data)
+        finally:
+            done.set()
+
+    def _ui_loop(self, stdin_data: Optional[str] = None):
+        pending = list(self.slots)
+        running: set[HostSlot] = set()
+        sel = selectors.DefaultSelector()
+
+        def _spawn(slot: HostSlot):
+            # rsync only emits smooth progress2 updates when stdout is a tty
+            master_fd, slave_fd = pty.openpty()
+            try:
+                slot.proc = popen_with_error_check(
+                    slot.cmd, stdin_data=stdin_data, stdout=slave_fd
+                )
+            except BaseException:
+                os.close(master_fd)
+                raise
+            finally:
+                os.close(slave_fd)
+            slot.fd = master_fd
+
+        def _spawn_pending():
+            # keep at most `jobs` rsync processes alive, each on its own UI line
+            while pending and len(running) < self.jobs:
+                slot = pending.pop(0)
+                _spawn(slot)
+                running.add(slot)
+                os.set_blocking(slot.fd, False)
+                sel.register(slot.fd, selectors.EVENT_READ, data=slot)
+                try:
+                    # the selector also wakes when the child exits (Linux >= 5.3)
+                    slot.pidfd = os.pidfd_open(slot.proc.pid)
+                except (AttributeError, OSError):
+                    continue
+                sel.register(slot.pidfd, selectors.EVENT_READ, data=slot)
+
+        def _reap(slot: HostSlot):
+            running.remove(slot)
+            slot.proc.wait()
+            _spawn_pending()
+
+        with UITool.ui_tool(len(self.slots)) as ui_tool:
+            try:
+                _spawn_pending()
+                # block until some rsync writes progress or exits instead of spinning
+                while sel.get_map() and not self._stop.is_set():
+                    for key, _ in sel.select(timeout=0.1):
+                        slot = key.data
+                        if key.fd == slot.pidfd:
+                            sel.unregister(key.fd)
+                            os.close(key.fd)
+                            _reap(slot)
+                            continue
+                        try:
+                            data = os.read(key.fd, 4096)
+                        except OSError:
+                            # Linux reports EIO on the master once the slave is closed
+                            data = b""
+                        if not data:
+                            # EOF: the process has closed its stdout
+                            sel.unregister(key.fd)
+                            os.close(key.fd)
+                            # without a pidfd the exit is only visible through EOF
+                            if slot.pidfd is None:
+                                _reap(slot)
+                            continue
+                        ui_tool.update_chunk(slot.line, data)
+            except Exception as e:
+                # ui_tool swallows exceptions, hand it to _run and stop the rest
+                self._error = e
+                self._stop.set()
+
+        if self._stop.is_set():
+            for slot in running:
+                slot.proc.terminate()
+        for key in list(sel.get_map().values()):
+            sel.unregister(key.fd)
+            os.close(key.fd)
+        sel.close()
 
     def sync(self):
+        self._print_target(self._relpath.as_posix())
+
         rsync_cmds = []
         for host in self.hosts:
-            # adding trailing slash to sync the content of the directory
-            is_folder = "/" if self.local_dir.is_dir() else ""
             rsync_cmds.append(
-                _sync_command(
-                    f"{host}:{self.remote_dir.as_posix()}{is_folder}",
-                    f"{self.local_dir.as_posix()}{is_folder}",
-                    self.delete,
-                    self.git_repo,
-                    self._probe_gitignore(),
+                self._sync_command(
+                    f"{self.local_dir.as_posix()}{self._trailing}",
+                    self._host_path(
+                        host, f"{self.remote_dir.as_posix()}{self._trailing}"
+                    ),
+                    extra_args=self._host_args(host),
                 )
             )
 
+        self._run(rsync_cmds, self._relpath.as_posix())
+
+    def sync_many(self, paths: list[Path]):
+        # one rsync per host for all paths, fed through --files-from on stdin;
+        # the transfer root stays the ancestor so anchored .gitignore rules
+        # match exactly as they do in sync()
+        ancestor = self.ancestor_to_sync
+        files_from = [p.relative_to(ancestor).as_posix() for p in paths]
+        remote_dir = Path(self.server_config["base_dir"]) / ancestor.name
+        relative_paths = [f"{ancestor.name}/{p}" for p in files_from]
+        self._print_target(", ".join(relative_paths))
+
+        rsync_cmds = []
+        for host in self.hosts:
+            rsync_cmds.append(
+                self._sync_command(
+                    f"{ancestor.as_posix()}/",
+                    self._host_path(host, f"{remote_dir.as_posix()}/"),
+                    # -a does not imply -r with --files-from
+                    extra_args=(
+                        *self._host_args(host),
+                        "-r",
+                        "--files-from=-",
+                    ),
+                )
+            )
+
+        self._run(rsync_cmds, ", ".join(relative_paths), "\n".join(files_from))
+
+    def _run(
+        self,
+        rsync_cmds: list[list[str]],
+        relative_path: str,
+        stdin_data: Optional[str] = None,
+    ):
         input("Press Enter to continue...")
         CursorTool.clear_screen()
-        relative_path = self.local_dir.relative_to(self.ancestor_to_sync.parent)
         typer.echo(
             f"Syncing local folder {blue_block(relative_path)} with remote hosts {blue_block(self.hosts)}"
             f"\n(delete={self.delete})"
             f"\n(git_repo={self.git_repo})"
+            f"\n(jobs={self.jobs})"
             f"\n===================================================================="
         )
 
-        rsync_procs: list[subprocess.Popen] = []
-        for cmd in rsync_cmds:
-            rsync_procs.append(popen_with_error_check(cmd))
-
-        self._ui_thread(rsync_procs)
-
-        for rsync_proc in rsync_procs:
-            rsync_proc.wait()
+        self.slots = [
+            HostSlot(line, host, cmd)
+            for line, (host, cmd) in enumerate(zip(self.hosts, rsync_cmds))
+        ]
+        # an interrupted Thread.join marks a live thread as finished on 3.11
+        # (gh-90882), so wait on an event the UI thread sets on its way out
+        done = threading.Event()
+        ui_t = threading.Thread(
+            target=self._ui_thread, args=(done, stdin_data), daemon=True
+        )
+        ui_t.start()
+        try:
+            # wait in slices so the main thread still sees Ctrl-C
+            while not done.wait(0.1):
+                pass
+        except KeyboardInterrupt:
+            self._stop.set()
+            done.wait()
+            raise typer.Exit("Interrupted, rsync processes terminated")
+
+        if self._error is not None:
+            raise self._error
 
         logger.log_one(
-            path=self.local_dir.relative_to(self.ancestor_to_sync.parent),
+            path=relative_path,
             hosts=self.hosts,
             delete=self.delete,
             git_repo=self.git_repo,
@@ -164,26 +366,34 @@ class SyncTool:
 @app.command()
 def sync(
     server: str = typer.Option(..., "--server", "-n"),
-    file_or_path: Optional[str] = typer.Option(None, "--file-or-path", "-f"),
+    file_or_path: Optional[list[str]] = typer.Option(
+        None, "--file-or-path", "-f", help="repeat to sync several paths at once"
+    ),
     delete: bool = typer.Option(False, "--delete", "-d"),
     git_repo: bool = typer.Option(False, "--git", "-g", help="sync git repo"),
+    jobs: int = typer.Option(
+        os.cpu_count(), "--jobs", "-j", help="max concurrent rsync processes"
+    ),
     config: str = typer.Option(DEFAULT_CONFIG, "--config"),
 ):
-    # read yaml from config
-    with open(config, "r") as f:
-        config_dict = yaml.safe_load(f)
+    config_dict = load_config(config)
 
     if server not in config_dict:
         raise typer.Exit(f"Invalid server(cluster) name: {server}")
 
+    many = file_or_path is not None and len(file_or_path) > 1
     sync_tool = SyncTool(
         config_dict[server],
-        file_or_path=file_or_path,
+        file_or_path=file_or_path[0] if file_or_path and not many else None,
         delete=delete,
         git_repo=git_repo,
+        jobs=jobs,
     )
 
-    sync_tool.sync()
+    if many:
+        sync_tool.sync_many([Path.cwd() / f for f in file_or_path])
+    else:
+        sync_tool.sync()
 
 
 if __name__ == "__main__":
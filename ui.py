@@ -1,65 +1,73 @@
+import re
 import sys
 import time
 from contextlib import contextmanager
+from functools import lru_cache
 from typing import Optional
 
-red_block = lambda x: f"\x1b[41m{x}\x1b[0m"
-blue_block = lambda x: f"\x1b[44m{x}\x1b[0m"
-yellow_block = lambda x: f"\x1b[43m{x}\x1b[0m"
-yellow_text = lambda x: f"\x1b[33m{x}\x1b[0m"
-red_text = lambda x: f"\x1b[31m{x}\x1b[0m"
+try:
+    import _ui_fast
+except ImportError:
+    _ui_fast = None
 
 
-class CursorTool:
-    @staticmethod
-    def move_up(n: int):
-        print("\x1b[%dA" % n, end="", flush=True)
+@lru_cache(maxsize=256)
+def _colored(code: str, x: str) -> str:
+    return "\x1b[" + code + "m" + x + "\x1b[0m"
 
-    @staticmethod
-    def move_down(n: int):
-        print("\x1b[%dB" % n, end="", flush=True)
 
-    @staticmethod
-    def move_right(n: int):
-        print("\x1b[%dC" % n, end="", flush=True)
+# labels (hosts, paths) repeat a lot, so the colored strings are memoized
+def red_block(x) -> str:
+    return _colored("41", str(x))
 
-    @staticmethod
-    def move_left(n: int):
-        print("\x1b[%dD" % n, end="", flush=True)
 
-    @staticmethod
-    def move_vertical(n: int):
-        if n > 0:
-            CursorTool.move_down(n)
-        elif n < 0:
-            CursorTool.move_up(-n)
+def blue_block(x) -> str:
+    return _colored("44", str(x))
 
-    @staticmethod
-    def move_horizontal(n: int):
-        if n > 0:
-            CursorTool.move_right(n)
-        elif n < 0:
-            CursorTool.move_left(-n)
 
-    @staticmethod
-    def reset_line():
-        print("\r", end="", flush=True)
+def yellow_block(x) -> str:
+    return _colored("43", str(x))
+
+
+def yellow_text(x) -> str:
+    return _colored("33", str(x))
 
-    @staticmethod
-    def hide_cursor():
-        print("\x1b[?25l", end="", flush=True)
 
+def red_text(x) -> str:
+    return _colored("31", str(x))
+
+
+_split_line_breaks = re.compile(b"[\r\n]").split
+
+HIDE_CURSOR = b"\x1b[?25l"
+SHOW_CURSOR = b"\x1b[?25h"
+
+
+class CursorTool:
     @staticmethod
-    def show_cursor():
-        print("\x1b[?25h", end="", flush=True)
+    def move_to_seq(n: int, col: int) -> bytes:
+        # relative row plus absolute column (CHA) in a single sequence, CUP would
+        # need the absolute origin row which only a DSR round-trip reveals
+        if n > 0:
+            seq = b"\x1b[%dB" % n
+        elif n < 0:
+            seq = b"\x1b[%dA" % -n
+        else:
+            seq = b""
+        return seq + b"\x1b[%dG" % (col + 1)
 
     @staticmethod
     def clear_screen():
-        print("\x1b[2J\x1b[H", end="", flush=True)
+        sys.stdout.write("\x1b[2J\x1b[H")
 
 
 class UITool:
     def __init__(self, max_lines: int):
+        # write encoded bytes straight to the buffered binary stdout and flush
+        # once per update, the text layer must not hold anything back
+        sys.stdout.flush()
+        self._out = sys.stdout.buffer
+
         self.max_lines = max_lines
         self.cur_line = 0
         self.cur_col = 0
@@ -71,39 +79,67 @@ class UITool:
         self.move_cursor(self.max_lines, 0)
 
     def move_cursor(self, line: Optional[int] = None, col: Optional[int] = None):
-        if line is not None:
-            CursorTool.move_vertical(line - self.cur_line)
-            self.cur_line = line
-        if col is not None:
-            CursorTool.move_horizontal(col - self.cur_col)
-            self.cur_col = col
+        line = self.cur_line if line is None else line
+        col = self.cur_col if col is None else col
+        if line != self.cur_line or col != self.cur_col:
+            self._emit(CursorTool.move_to_seq(line - self.cur_line, col))
+            self.cur_line, self.cur_col = line, col
 
-    def print_char(self, char: str):
-        print(char, end="", flush=True)
-        self.cur_col += 1
+    def _emit(self, b: bytes):
+        self._out.write(b)
 
     def print_line(self, content: str):
-        print(content, end="", flush=True)
+        self._emit(content.encode())
         self.cur_col += len(content)
 
-    def update_char(self, line: int, char: str):
-        assert 0 <= line < self.max_lines
+    def print_bytes(self, content: bytes):
+        self._emit(content)
+        self.cur_col += len(content)
 
-        if char in ["\n", "\r"]:
-            self.line_pos[line] = 0
-        else:
-            self.move_cursor(line, self.line_pos[line])
-            self.print_char(char)
-            self.line_pos[line] = self.cur_col
+    def update_char(self, line: int, char: str):
+        self.update_chunk(line, char.encode())
+
+    def update_chunk(self, line: int, data: bytes):
+        if _ui_fast is not None:
+            self._emit(
+                _ui_fast.update_chunk(
+                    self.line_pos,
+                    line,
+                    self.cur_line,
+                    self.cur_col,
+                    self.max_lines,
+                    data,
+                )
+            )
+            self.cur_line, self.cur_col = self.max_lines, 0
+            self._out.flush()
+            return
+
+        # hot path: no bounds assert, attribute lookups hoisted out of the loop
+        line_pos = self.line_pos
+        move_cursor = self.move_cursor
+        print_bytes = self.print_bytes
+
+        # each "\r" or "\n" rewinds the line, runs in between are written at once
+        for i, run in enumerate(_split_line_breaks(data)):
+            if i:
+                line_pos[line] = 0
+            if run:
+                move_cursor(line, line_pos[line])
+                print_bytes(run)
+                line_pos[line] = self.cur_col
 
         self.reset_pos()
+        self._out.flush()
 
     def update_line(self, line: int, content: str):
+        assert 0 <= line <= self.max_lines
         assert "\r" not in content and "\n" not in content
 
         self.move_cursor(line, 0)
         self.print_line(content)
         self.reset_pos()
+        self._out.flush()
 
     def print_desc(self, desc: str):
         desc = f"{'=' * 5} {desc} {'=' * 5}"
@@ -112,16 +148,18 @@ class UITool:
     @staticmethod
     @contextmanager
     def ui_tool(max_lines: int, desc: Optional[str] = "TinyUI"):
-        CursorTool.hide_cursor()
+        sys.stdout.flush()
+        out = sys.stdout.buffer
+        out.write(HIDE_CURSOR)
         try:
             tool = UITool(max_lines)
             tool.print_desc(desc)
             yield tool
         except Exception as e:
-            print(e)
+            print(e, flush=True)
         finally:
-            CursorTool.show_cursor()
-            sys.stdout.write("\n")
+            out.write(SHOW_CURSOR + b"\n")
+            out.flush()
 
 
 def test():
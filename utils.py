@@ -1,9 +1,21 @@
 import os
+import pickle
 import subprocess
 import threading
+from pathlib import Path
+from typing import Optional
+
+import yaml
 
 from ui import red_block, red_text
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+CONFIG_CACHE = Path.home() / ".cache" / "lsync" / "config.pkl"
+
 
 def get_lsync_dir() -> str:
     lsync_dir = os.environ.get("LSYNC_DIR", None)
@@ -12,17 +24,64 @@ def get_lsync_dir() -> str:
     return lsync_dir
 
 
-def popen_with_error_check(command: list[str], allow_exit: bool = True):
+def load_config(config: str) -> dict:
+    # the parsed yaml is pickled and reused until the config file changes
+    st = os.stat(config)
+    key = (os.path.abspath(config), st.st_mtime_ns, st.st_size)
+    try:
+        with CONFIG_CACHE.open("rb") as f:
+            cached_key, config_dict = pickle.load(f)
+        if cached_key == key:
+            return config_dict
+    except Exception:
+        # a missing, corrupt or foreign cache file is just a cache miss
+        pass
+
+    with open(config, "r") as f:
+        config_dict = yaml.load(f, Loader=SafeLoader)
+
+    # caching is best-effort, a read-only or full ~/.cache must not stop a sync
+    try:
+        CONFIG_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = CONFIG_CACHE.with_suffix(f".{os.getpid()}.tmp")
+        with tmp_file.open("wb") as f:
+            pickle.dump((key, config_dict), f)
+        os.replace(tmp_file, CONFIG_CACHE)
+    except OSError:
+        pass
+
+    return config_dict
+
+
+def popen_with_error_check(
+    command: list[str],
+    allow_exit: bool = True,
+    stdin_data: Optional[str] = None,
+    stdout=subprocess.PIPE,
+):
+    # fds created by python are non-inheritable (PEP 446), so skipping the
+    # close-all-fds sweep in the child leaks nothing and spawns faster
     process = subprocess.Popen(
         command,
-        stdout=subprocess.PIPE,
+        stdin=subprocess.PIPE if stdin_data is not None else None,
+        stdout=stdout,
         stderr=subprocess.PIPE,
         text=True,
         encoding="utf-8",
         errors="replace",
+        close_fds=False,
     )
 
     def _run_and_check():
+        # feed stdin here so a large payload never blocks the caller's thread
+        if process.stdin:
+            try:
+                process.stdin.write(stdin_data)
+                process.stdin.close()
+            except BrokenPipeError:
+                # the process exited early, its return code reports why
+                pass
+
         process.wait()
 
         if not allow_exit or process.returncode != 0: